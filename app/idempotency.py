@@ -0,0 +1,293 @@
+"""Replay protection for the store-* endpoints via the `Idempotency-Key` header.
+
+The first request with a given key runs the write and its response is stored
+(MongoDB, TTL-indexed, with an in-memory front cache). Retries with the same key
+get the stored response back without writing again.
+Concurrent retries wait for the first request instead of racing it:
+an asyncio.Lock per key covers this process, a "claim" document covers other workers.
+Claims are leased and renewed while the write runs, so a worker that dies mid-request doesn't block the key.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from hashlib import sha256
+from time import monotonic
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+from starlette.responses import Response
+from starlette.status import HTTP_409_CONFLICT, HTTP_422_UNPROCESSABLE_ENTITY
+
+from app.model.idempotency_key import idempotency_keys_table
+from configuration import IDEMPOTENCY_KEY_TTL_SECONDS, IDEMPOTENCY_CACHE_MAX_ENTRIES, IDEMPOTENCY_WAIT_SECONDS, \
+    IDEMPOTENCY_POLL_INTERVAL_SECONDS, IDEMPOTENCY_CLAIM_LEASE_SECONDS, IDEMPOTENCY_KEY_MAX_LENGTH, \
+    IDEMPOTENCY_STORE_ATTEMPTS
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+_MONGODB_INDEX_OPTIONS_CONFLICT = 85
+
+logger = logging.getLogger(__name__)
+
+
+class _StoredResponse(NamedTuple):
+    statusCode: int
+    body: bytes
+    fingerprint: str
+    # Same moment the DB copy expires (its "createdAt" + TTL)
+    expiresAt: datetime
+
+
+class _KeyLock:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class _LeaseHeartbeat(threading.Thread):
+    """Keeps pushing the claim's lease forward until stopped.
+
+    Runs in a thread, since pymongo calls inside the write block the event loop.
+    """
+
+    def __init__(self, scoped_key: str, claim_token: str):
+        super().__init__(daemon=True)
+        self.scoped_key = scoped_key
+        self.claim_token = claim_token
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(IDEMPOTENCY_CLAIM_LEASE_SECONDS / 3):
+            try:
+                result = idempotency_keys_table.update_one(
+                    {"_id": self.scoped_key, "claimToken": self.claim_token, "statusCode": None},
+                    {"$set": {"leaseExpiresAt": _lease_expiration()}})
+            except PyMongoError:
+                # (next beat retries)
+                continue
+            if not result.matched_count:
+                # Response stored, claim released or taken over; nothing left to renew
+                return
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+# scoped key -> stored response; least recently used first
+_cached_responses: "OrderedDict[str, _StoredResponse]" = OrderedDict()
+_key_locks: Dict[str, _KeyLock] = {}
+
+
+def ensure_ttl_index() -> None:
+    try:
+        idempotency_keys_table.create_index("createdAt", expireAfterSeconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+    except OperationFailure as e:
+        if e.code != _MONGODB_INDEX_OPTIONS_CONFLICT:
+            raise
+        # IDEMPOTENCY_KEY_TTL_SECONDS was edited since the index was created
+        idempotency_keys_table.database.command("collMod", idempotency_keys_table.name,
+                                                index={"keyPattern": {"createdAt": 1},
+                                                       "expireAfterSeconds": IDEMPOTENCY_KEY_TTL_SECONDS})
+
+
+async def idempotent_response(key: Optional[str], path: str, body: Dict,
+                              write: Callable[[], Awaitable[Response]]) -> Response:
+    """Return the stored response for `key`, or run `write` once and store its response.
+
+    Without a key, `write` simply runs.
+    Empty or overlong keys, and reusing a key with a different `body`, are rejected with 422.
+    Failed writes (e.g. HTTPException) are not stored, so the client can retry them.
+    """
+    if key is None:
+        return await write()
+    _raise_if_invalid_key(key)
+
+    scoped_key = path + ":" + key
+    fingerprint = _fingerprint(body)
+    claim_token = str(uuid4())
+    async with _key_lock(scoped_key):
+        stored = _cached_response(scoped_key) or await _stored_response_or_claim(scoped_key, fingerprint,
+                                                                                 claim_token=claim_token)
+        if stored:
+            _raise_if_other_body(stored_fingerprint=stored.fingerprint, fingerprint=fingerprint)
+            return _replayed(stored)
+
+        heartbeat = _LeaseHeartbeat(scoped_key, claim_token=claim_token)
+        heartbeat.start()
+        try:
+            try:
+                response = await write()
+            except BaseException:
+                _release_claim(scoped_key, claim_token=claim_token)
+                raise
+            await _store_response(scoped_key, claim_token=claim_token, response=response, fingerprint=fingerprint)
+        finally:
+            heartbeat.stop()
+        return response
+
+
+def _raise_if_invalid_key(key: str) -> None:
+    if not key.strip() or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"{IDEMPOTENCY_KEY_HEADER} must be non-empty "
+                                   f"and at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters.")
+
+
+@asynccontextmanager
+async def _key_lock(scoped_key: str):
+    """Hold the per-key lock; the entry is dropped once no request uses it."""
+    key_lock = _key_locks.get(scoped_key)
+    if key_lock is None:
+        key_lock = _key_locks[scoped_key] = _KeyLock()
+    key_lock.users += 1
+    try:
+        async with key_lock.lock:
+            yield
+    finally:
+        key_lock.users -= 1
+        if not key_lock.users:
+            _key_locks.pop(scoped_key)
+
+
+def _fingerprint(body: Dict) -> str:
+    return sha256(json.dumps(jsonable_encoder(body), sort_keys=True).encode()).hexdigest()
+
+
+def _raise_if_other_body(stored_fingerprint: str, fingerprint: str) -> None:
+    if stored_fingerprint != fingerprint:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"{IDEMPOTENCY_KEY_HEADER} was already used with a different request body.")
+
+
+def _replayed(stored: _StoredResponse) -> Response:
+    return Response(status_code=stored.statusCode, content=stored.body, media_type="application/json")
+
+
+def _cached_response(scoped_key: str) -> Optional[_StoredResponse]:
+    stored = _cached_responses.get(scoped_key)
+    if stored is None:
+        return None
+    if stored.expiresAt < datetime.utcnow():
+        _cached_responses.pop(scoped_key)
+        return None
+    _cached_responses.move_to_end(scoped_key)
+    return stored
+
+
+def _cache_response(scoped_key: str, stored: _StoredResponse) -> None:
+    _cached_responses[scoped_key] = stored
+    _cached_responses.move_to_end(scoped_key)
+    while len(_cached_responses) > IDEMPOTENCY_CACHE_MAX_ENTRIES:
+        _cached_responses.popitem(last=False)
+
+
+def _expiration(created_at: datetime) -> datetime:
+    return created_at + timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+
+
+def _lease_expiration() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_CLAIM_LEASE_SECONDS)
+
+
+async def _store_response(scoped_key: str, claim_token: str, response: Response, fingerprint: str) -> None:
+    """Store the response in the claim document (retried; the heartbeat keeps the lease meanwhile).
+
+    The response is cached only if this worker still owns the claim.
+    If it can't be stored, the claim is marked "completed" so other workers answer 409 instead of writing again.
+    """
+    # "createdAt" restarts the TTL, so the response is kept for the full TTL after the write
+    now = datetime.utcnow()
+    stored = _StoredResponse(statusCode=response.status_code, body=response.body,
+                             fingerprint=fingerprint, expiresAt=_expiration(now))
+    claim_filter = {"_id": scoped_key, "claimToken": claim_token}
+    for attempt in range(1, IDEMPOTENCY_STORE_ATTEMPTS + 1):
+        try:
+            result = idempotency_keys_table.update_one(claim_filter,
+                                                       {"$set": {"createdAt": now,
+                                                                 "statusCode": response.status_code,
+                                                                 "body": response.body}})
+            break
+        except PyMongoError:
+            logger.warning("Storing response for %s failed (attempt %d of %d).",
+                           scoped_key, attempt, IDEMPOTENCY_STORE_ATTEMPTS, exc_info=True)
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL_SECONDS)
+    else:
+        logger.error("Response for %s couldn't be stored; retries with this key get 409.", scoped_key)
+        _mark_completed_without_response(claim_filter)
+        # (this worker can still replay it)
+        _cache_response(scoped_key, stored)
+        return
+
+    if not result.matched_count:
+        logger.warning("Claim for %s was taken over by another worker during the write; "
+                       "the stored response is the other worker's.", scoped_key)
+        return
+    _cache_response(scoped_key, stored)
+
+
+def _mark_completed_without_response(claim_filter: Dict) -> None:
+    try:
+        idempotency_keys_table.update_one(claim_filter, {"$set": {"completed": True}})
+    except PyMongoError:
+        logger.exception("Marking %s as completed failed; its lease will expire.", claim_filter["_id"])
+
+
+def _release_claim(scoped_key: str, claim_token: str) -> None:
+    try:
+        idempotency_keys_table.delete_one({"_id": scoped_key, "claimToken": claim_token, "statusCode": None})
+    except PyMongoError:
+        # (the claim is released anyway when its lease expires)
+        pass
+
+
+async def _stored_response_or_claim(scoped_key: str, fingerprint: str, claim_token: str) -> Optional[_StoredResponse]:
+    """Claim the key in the DB, or wait for the worker holding the claim to store its response.
+
+    A claim whose lease expired (its worker died) is taken over.
+    Returns None when the claim succeeded (caller must run the write).
+    """
+    deadline = monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        now = datetime.utcnow()
+        claim = {"createdAt": now,
+                 "leaseExpiresAt": _lease_expiration(),
+                 "claimToken": claim_token,
+                 "fingerprint": fingerprint,
+                 "statusCode": None}
+        try:
+            idempotency_keys_table.insert_one({"_id": scoped_key, **claim})
+            return None
+        except DuplicateKeyError:
+            pass
+
+        if idempotency_keys_table.find_one_and_update({"_id": scoped_key,
+                                                       "statusCode": None,
+                                                       "completed": {"$ne": True},
+                                                       "leaseExpiresAt": {"$lt": now}},
+                                                      {"$set": claim}):
+            return None
+
+        match = idempotency_keys_table.find_one({"_id": scoped_key})
+        # (match is None when the other worker's write failed and its claim was removed; try claiming again)
+        if match:
+            _raise_if_other_body(stored_fingerprint=match["fingerprint"], fingerprint=fingerprint)
+            if match["statusCode"] is not None:
+                stored = _StoredResponse(statusCode=match["statusCode"], body=bytes(match["body"]),
+                                         fingerprint=match["fingerprint"], expiresAt=_expiration(match["createdAt"]))
+                _cache_response(scoped_key, stored)
+                return stored
+            if match.get("completed"):
+                raise HTTPException(status_code=HTTP_409_CONFLICT,
+                                    detail=f"Previous request with this {IDEMPOTENCY_KEY_HEADER} succeeded, "
+                                           f"but its response is unavailable.")
+
+        if monotonic() > deadline:
+            raise HTTPException(status_code=HTTP_409_CONFLICT,
+                                detail=f"Previous request with this {IDEMPOTENCY_KEY_HEADER} is still in progress.")
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL_SECONDS)
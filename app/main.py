@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Iterable, Dict
-from fastapi import FastAPI, HTTPException, Request
+from typing import Iterable, Dict, Optional
+from fastapi import FastAPI, HTTPException, Request, Header
 from starlette.datastructures import Headers
 from starlette.responses import JSONResponse, Response
 from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY, HTTP_201_CREATED, HTTP_404_NOT_FOUND
@@ -9,6 +9,7 @@ from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY, HTTP_201_CREATED, HT
 import uvicorn
 import jwt  # requires PyJWT, despite not mentioning it
 
+from app.idempotency import idempotent_response, ensure_ttl_index, IDEMPOTENCY_KEY_HEADER
 from app.model.home import homes_table, Home
 from app.model.senior import seniors_table, Senior
 from app.model.sensor import sensors_table, Sensor
@@ -36,29 +37,46 @@ class EndpointPath(str, Enum):
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def create_indexes():
+    ensure_ttl_index()
+
+
 @app.post(EndpointPath.store_home)
-async def store_home(newHome: Home):
-    homes_table.insert_one(newHome.dict())
-    return JSONResponse(status_code=HTTP_201_CREATED, content=newHome.dict())
+async def store_home(newHome: Home, idempotencyKey: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER)):
+    async def write():
+        homes_table.insert_one(newHome.dict())
+        return JSONResponse(status_code=HTTP_201_CREATED, content=newHome.dict())
+
+    return await idempotent_response(key=idempotencyKey, path=EndpointPath.store_home, body=newHome.dict(),
+                                     write=write)
 
 
 @app.post(EndpointPath.store_sensor)
-async def store_sensor(newSensor: Sensor):
-    sensors_table.insert_one(newSensor.dict())
-    return JSONResponse(status_code=HTTP_201_CREATED, content=newSensor.dict())
+async def store_sensor(newSensor: Sensor, idempotencyKey: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER)):
+    async def write():
+        sensors_table.insert_one(newSensor.dict())
+        return JSONResponse(status_code=HTTP_201_CREATED, content=newSensor.dict())
+
+    return await idempotent_response(key=idempotencyKey, path=EndpointPath.store_sensor, body=newSensor.dict(),
+                                     write=write)
 
 
 @app.post(EndpointPath.store_senior)
-async def store_senior(newSenior: Senior):
-    d = newSenior.dict()
-    await _raise_if_home_doesnt_exist(homeId=d["homeId"])
-    # Ignore "enabled" and "sensorId"
-    d["enabled"] = False
-    if "sensorId" in d:
-        d.pop("sensorId")
-    seniors_table.insert_one(d)
-    d.pop("_id")
-    return JSONResponse(status_code=HTTP_201_CREATED, content=d)
+async def store_senior(newSenior: Senior, idempotencyKey: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER)):
+    async def write():
+        d = newSenior.dict()
+        await _raise_if_home_doesnt_exist(homeId=d["homeId"])
+        # Ignore "enabled" and "sensorId"
+        d["enabled"] = False
+        if "sensorId" in d:
+            d.pop("sensorId")
+        seniors_table.insert_one(d)
+        d.pop("_id")
+        return JSONResponse(status_code=HTTP_201_CREATED, content=d)
+
+    return await idempotent_response(key=idempotencyKey, path=EndpointPath.store_senior, body=newSenior.dict(),
+                                     write=write)
 
 
 async def _raise_if_home_doesnt_exist(homeId) -> None:
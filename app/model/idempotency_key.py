@@ -0,0 +1,5 @@
+from app.model._base import db
+
+# Responses of store-* requests, keyed by "<path>:<Idempotency-Key>".
+# Documents expire through a TTL index on "createdAt" (see app.idempotency.ensure_ttl_index).
+idempotency_keys_table = db['idempotency_keys']
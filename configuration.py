@@ -7,6 +7,19 @@ JWT_USER_NAME = "backend-SW-Engineer-Candidate"
 JWT_DURATION_HOURS = 1
 JWT_ALGORITHM = "HS256"
 
+# ------------------------------------------------------------------------------------
+# Idempotency-Key header (store-* endpoints)
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_CACHE_MAX_ENTRIES = 1024
+# How long a replay waits for the first request (possibly on another worker) to finish
+IDEMPOTENCY_WAIT_SECONDS = 10
+IDEMPOTENCY_POLL_INTERVAL_SECONDS = 0.1
+# A worker that dies mid-request blocks its key only this long (renewed while the write runs)
+IDEMPOTENCY_CLAIM_LEASE_SECONDS = 5
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Attempts to store the response after a successful write
+IDEMPOTENCY_STORE_ATTEMPTS = 3
+
 # ------------------------------------------------------------------------------------
 #                 EDIT THE SECRETS:
 #
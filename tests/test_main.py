@@ -1,10 +1,20 @@
+import asyncio
 from abc import ABC, abstractmethod
 from copy import deepcopy
+from datetime import datetime, timedelta
 from json import JSONDecodeError
 from unittest import TestCase
+from unittest.mock import patch
+from uuid import uuid4
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from pymongo.errors import AutoReconnect
+from starlette.responses import JSONResponse
 
+from app.idempotency import IDEMPOTENCY_KEY_HEADER, idempotent_response, ensure_ttl_index, _fingerprint, \
+    _key_locks, _cached_responses, _stored_response_or_claim
 from app.model.home import HomeTypes
+from app.model.idempotency_key import idempotency_keys_table
 from app.secret_handler import API_KEY_VALUE_PAIR
 from app.main import app, homes_table, sensors_table, seniors_table, EndpointPath
 
@@ -374,3 +384,209 @@ class TestGetSenior(TestCaseWithDeletion):
         self._assert_response_code_is_x(data=self.valid_body_deepcopy(), x=401,
                                         client=self.client, path=self.PATH_GET_SENIOR, r_type='post',
                                         headers=TOKEN_HEADER)
+
+
+class TestIdempotencyKey(TestEntriesDeletionInDB, TestCase):
+    VALID_HOME_EXAMPLE = {"homeId": 23897524,
+                          "name": _DELETION_MARKER_STRING,
+                          "type": HomeTypes.private}
+
+    @property
+    def collection_name(self):
+        return homes_table
+
+    @property
+    def key_with_deletion_marker_value(self):
+        return "name"
+
+    def setUp(self) -> None:
+        self.client = TestClient(app)
+        self.key = str(uuid4())
+        self.headers = deepcopy(final_extra_header)
+        self.headers[IDEMPOTENCY_KEY_HEADER] = self.key
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        idempotency_keys_table.delete_many({"_id": {"$regex": self.key}})
+
+    def _stored_homes_count(self):
+        return homes_table.count_documents(self.VALID_HOME_EXAMPLE)
+
+    def test_replay_returns_original_response(self):
+        r1 = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                           headers=self.headers)
+        r2 = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                           headers=self.headers)
+        self.assertEqual(201, r1.status_code)
+        self.assertEqual(r1.status_code, r2.status_code)
+        self.assertEqual(r1.json(), r2.json())
+
+    def test_replay_doesnt_write_again(self):
+        for _ in range(3):
+            post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                          headers=self.headers)
+        self.assertEqual(1, self._stored_homes_count())
+
+    def test_no_key_writes_every_time(self):
+        for _ in range(2):
+            post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home)
+        self.assertEqual(2, self._stored_homes_count())
+
+    def test_key_reused_with_other_body(self):
+        post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                      headers=self.headers)
+        d = deepcopy(self.VALID_HOME_EXAMPLE)
+        d["type"] = HomeTypes.nursing
+        r = post_response(data=d, client=self.client, path=EndpointPath.store_home, headers=self.headers)
+        self.assertEqual(422, r.status_code)
+        self.assertEqual(0, homes_table.count_documents(d))
+
+    def test_failed_write_not_stored(self):
+        senior = deepcopy(TestStoreSenior.VALID_SENIOR_EXAMPLE)
+        # (non-existing home, as in TestStoreSenior.test_store_at_non_existing_home)
+        senior["homeId"] = 999999999
+        r = post_response(data=senior, client=self.client, path=EndpointPath.store_senior, headers=self.headers)
+        self.assertEqual(422, r.status_code)
+        self.assertIsNone(idempotency_keys_table.find_one({"_id": {"$regex": self.key}}))
+
+    @property
+    def scoped_key(self):
+        return EndpointPath.store_home + ":" + self.key
+
+    def _idempotent_store_home(self, write_seconds=0.2, during_write=lambda: None):
+        async def slow_home_write():
+            await asyncio.sleep(write_seconds)
+            during_write()
+            homes_table.insert_one(deepcopy(self.VALID_HOME_EXAMPLE))
+            return JSONResponse(status_code=201, content={"requestId": str(uuid4())})
+
+        return idempotent_response(key=self.key, path=EndpointPath.store_home, body=self.VALID_HOME_EXAMPLE,
+                                   write=slow_home_write)
+
+    def test_empty_key_rejected(self):
+        self.headers[IDEMPOTENCY_KEY_HEADER] = ""
+        r = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                          headers=self.headers)
+        self.assertEqual(422, r.status_code)
+        self.assertEqual(0, self._stored_homes_count())
+
+    def test_whitespace_key_rejected(self):
+        self.key = "   "
+        with self.assertRaises(HTTPException) as e:
+            asyncio.run(self._idempotent_store_home())
+        self.assertEqual(422, e.exception.status_code)
+
+    def test_overlong_key_rejected(self):
+        self.headers[IDEMPOTENCY_KEY_HEADER] = "k" * 10_000
+        r = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                          headers=self.headers)
+        self.assertEqual(422, r.status_code)
+        self.assertEqual(0, self._stored_homes_count())
+
+    def test_concurrent_replays_wait_for_first(self):
+        async def replays():
+            return await asyncio.gather(*(self._idempotent_store_home() for _ in range(3)))
+
+        responses = asyncio.run(replays())
+        self.assertEqual(1, self._stored_homes_count())
+        self.assertEqual({201}, {r.status_code for r in responses})
+        self.assertEqual(1, len({r.body for r in responses}))
+        self.assertEqual({}, _key_locks)
+
+    def _insert_claim_of_other_worker(self, lease_seconds):
+        now = datetime.utcnow()
+        idempotency_keys_table.insert_one({"_id": self.scoped_key,
+                                           "createdAt": now,
+                                           "leaseExpiresAt": now + timedelta(seconds=lease_seconds),
+                                           "claimToken": "other worker",
+                                           "fingerprint": _fingerprint(self.VALID_HOME_EXAMPLE),
+                                           "statusCode": None})
+
+    def test_waits_for_claim_of_other_worker(self):
+        self._insert_claim_of_other_worker(lease_seconds=60)
+        body_of_other_worker = b'{"from": "other worker"}'
+
+        async def other_worker_finishes():
+            await asyncio.sleep(0.3)
+            idempotency_keys_table.update_one({"_id": self.scoped_key},
+                                              {"$set": {"statusCode": 201, "body": body_of_other_worker}})
+
+        async def replay_while_other_worker_runs():
+            return await asyncio.gather(self._idempotent_store_home(), other_worker_finishes())
+
+        response, _ = asyncio.run(replay_while_other_worker_runs())
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(body_of_other_worker, response.body)
+        self.assertEqual(0, self._stored_homes_count())
+
+    @patch("app.idempotency.IDEMPOTENCY_WAIT_SECONDS", 0.3)
+    def test_claim_of_other_worker_still_in_progress(self):
+        self._insert_claim_of_other_worker(lease_seconds=60)
+        r = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                          headers=self.headers)
+        self.assertEqual(409, r.status_code)
+        self.assertEqual(0, self._stored_homes_count())
+
+    def test_expired_claim_taken_over(self):
+        self._insert_claim_of_other_worker(lease_seconds=-1)
+        r = post_response(data=self.VALID_HOME_EXAMPLE, client=self.client, path=EndpointPath.store_home,
+                          headers=self.headers)
+        self.assertEqual(201, r.status_code)
+        self.assertEqual(1, self._stored_homes_count())
+
+    @patch("app.idempotency.IDEMPOTENCY_CLAIM_LEASE_SECONDS", 0.3)
+    def test_write_outliving_lease_not_taken_over(self):
+        async def other_worker_replays():
+            await asyncio.sleep(0.6)
+            # (called directly, as the per-key lock only serializes requests of this worker)
+            return await _stored_response_or_claim(self.scoped_key, _fingerprint(self.VALID_HOME_EXAMPLE),
+                                                   claim_token="other worker")
+
+        async def replay_during_long_write():
+            return await asyncio.gather(self._idempotent_store_home(write_seconds=1.0), other_worker_replays())
+
+        response, replayed = asyncio.run(replay_during_long_write())
+        self.assertIsNotNone(replayed)
+        self.assertEqual(response.body, replayed.body)
+        self.assertEqual(1, self._stored_homes_count())
+
+    def test_lost_claim_not_cached(self):
+        def other_worker_takes_over():
+            idempotency_keys_table.update_one({"_id": self.scoped_key}, {"$set": {"claimToken": "other worker"}})
+
+        with self.assertLogs("app.idempotency", level="WARNING"):
+            response = asyncio.run(self._idempotent_store_home(during_write=other_worker_takes_over))
+        self.assertEqual(201, response.status_code)
+        self.assertNotIn(self.scoped_key, _cached_responses)
+        self.assertIsNone(idempotency_keys_table.find_one({"_id": self.scoped_key})["statusCode"])
+
+    def test_response_not_stored_blocks_other_workers(self):
+        update_one = idempotency_keys_table.update_one
+
+        def update_one_failing_to_store(filter_, update):
+            if "body" in update["$set"]:
+                raise AutoReconnect("test")
+            return update_one(filter_, update)
+
+        with patch.object(idempotency_keys_table, "update_one", side_effect=update_one_failing_to_store), \
+                self.assertLogs("app.idempotency", level="ERROR"):
+            response = asyncio.run(self._idempotent_store_home())
+        self.assertEqual(201, response.status_code)
+        self.assertTrue(idempotency_keys_table.find_one({"_id": self.scoped_key})["completed"])
+
+        with self.assertRaises(HTTPException) as e:
+            asyncio.run(_stored_response_or_claim(self.scoped_key, _fingerprint(self.VALID_HOME_EXAMPLE),
+                                                  claim_token="other worker"))
+        self.assertEqual(409, e.exception.status_code)
+        self.assertEqual(1, self._stored_homes_count())
+
+
+class TestIdempotencyTTLIndex(TestCase):
+    def tearDown(self) -> None:
+        ensure_ttl_index()
+
+    def test_changed_ttl_updates_index(self):
+        ensure_ttl_index()
+        with patch("app.idempotency.IDEMPOTENCY_KEY_TTL_SECONDS", 60):
+            ensure_ttl_index()
+        self.assertEqual(60, idempotency_keys_table.index_information()["createdAt_1"]["expireAfterSeconds"])